@@ -0,0 +1,78 @@
+import numpy as np
+
+try:
+    import cupy as cp
+    GPU_AVAILABLE = cp.cuda.is_available()
+except ImportError:
+    cp = None
+    GPU_AVAILABLE = False
+
+# Only meshes this large amortize the host/device transfers
+GPU_MIN_TRIANGLES = 100_000
+
+# Upper bound on (triangle, voxel) pairs tested per device batch, which caps
+# the temporaries of a batch at a few hundred MB however large triangles get
+GPU_MAX_PAIRS = 1 << 20
+
+def voxelize_gpu(tri_verts, tri_edges, tri_normals, tri_d, tri_lo, tri_hi, resolution):
+    """Rasterize triangles given in voxel space on the GPU with CuPy
+    
+    Runs the same separating axis test as tri_box_overlap, vectorized over
+    the (triangle, candidate voxel) pairs of all bounding boxes, streamed in
+    fixed-size batches that may split a large triangle. Returns a bit-packed
+    grid with 64 voxels per uint64 word along z, like voxelize_numba.
+    """
+    # Pad z to whole uint64 words so packing never crosses a row
+    words = (resolution + 63) // 64
+    grid = cp.zeros((resolution, resolution, words * 64), dtype=bool)
+    
+    verts = cp.asarray(tri_verts)
+    edges = cp.asarray(tri_edges)
+    normals = cp.asarray(tri_normals)
+    d = cp.asarray(tri_d)
+    lo = cp.asarray(tri_lo, dtype=cp.int64)
+    dims = cp.asarray(tri_hi, dtype=cp.int64) - lo
+    
+    # Cross products of the three box axes with every edge: (T, 9, 3)
+    basis = cp.eye(3, dtype=cp.float32)
+    axes = cp.cross(basis[None, None, :, :], edges[:, :, None, :]).reshape(-1, 9, 3)
+    
+    # Every candidate voxel of every bounding box gets a global pair index
+    counts = dims.prod(axis=1)
+    ends = cp.cumsum(counts)
+    starts = ends - counts
+    total = int(ends[-1]) if len(ends) else 0
+    
+    half = np.float32(0.5)
+    for first in range(0, total, GPU_MAX_PAIRS):
+        # Map this batch of pair indices back to triangles and box-local indices
+        pairs = cp.arange(first, min(first + GPU_MAX_PAIRS, total))
+        pair_triangles = cp.searchsorted(ends, pairs, side='right')
+        local = pairs - starts[pair_triangles]
+        
+        # Unravel each local index inside its triangle's bounding box
+        ny, nz = dims[pair_triangles, 1], dims[pair_triangles, 2]
+        voxels = lo[pair_triangles] + cp.stack([local // (ny * nz), (local // nz) % ny, local % nz], axis=1)
+        centers = voxels.astype(cp.float32) + half
+        
+        # Triangle normal: the box must straddle the triangle plane
+        n = normals[pair_triangles]
+        plane = cp.abs((n * centers).sum(axis=1) + d[pair_triangles])
+        overlap = plane <= half * cp.abs(n).sum(axis=1)
+        
+        # Box face normals
+        v = verts[pair_triangles] - centers[:, None, :]
+        overlap &= ((v.min(axis=1) <= half) & (v.max(axis=1) >= -half)).all(axis=1)
+        
+        # Nine cross products of the box axes with the triangle edges
+        a = axes[pair_triangles]
+        proj = cp.einsum('pak,pvk->pav', a, v)
+        r = half * cp.abs(a).sum(axis=2)
+        overlap &= ((proj.min(axis=2) <= r) & (proj.max(axis=2) >= -r)).all(axis=1)
+        
+        hits = voxels[overlap]
+        grid[hits[:, 0], hits[:, 1], hits[:, 2]] = True
+    
+    # Pack 64 voxels per word on the device and copy the small result back
+    packed = cp.packbits(grid.ravel(), bitorder='little').reshape(resolution, resolution, words * 8)
+    return cp.asnumpy(packed).view('<u8').astype(np.uint64, copy=False)
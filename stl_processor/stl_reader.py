@@ -18,17 +18,15 @@ class STLReader:
         if self.mesh is None:
             self.read()
             
-        minx = min(self.mesh.x.flatten())
-        maxx = max(self.mesh.x.flatten())
-        miny = min(self.mesh.y.flatten())
-        maxy = max(self.mesh.y.flatten())
-        minz = min(self.mesh.z.flatten())
-        maxz = max(self.mesh.z.flatten())
+        # Per-axis bounds in a single pass over all vertices
+        verts = self.mesh.vectors.reshape(-1, 3)
+        mins = verts.min(axis=0)
+        maxs = verts.max(axis=0)
         
         return {
-            'x': (minx, maxx),
-            'y': (miny, maxy),
-            'z': (minz, maxz)
+            'x': (mins[0], maxs[0]),
+            'y': (mins[1], maxs[1]),
+            'z': (mins[2], maxs[2])
         }
     
     def calculate_optimal_voxel_resolution(self):
@@ -1,182 +1,318 @@
+import cc3d
 import numpy as np
+from functools import lru_cache
+from numba import njit, prange, set_parallel_chunksize
 from scipy import ndimage
 from pathlib import Path
-from stl import mesh
+from .gpu_voxelizer import GPU_AVAILABLE, GPU_MIN_TRIANGLES, voxelize_gpu
+
+# The 8 vertices of a unit cube
+_CUBE_VERTICES = np.array([
+    [0, 0, 0],   # 0
+    [1, 0, 0],   # 1
+    [1, 1, 0],   # 2
+    [0, 1, 0],   # 3
+    [0, 0, 1],   # 4
+    [1, 0, 1],   # 5
+    [1, 1, 1],   # 6
+    [0, 1, 1]    # 7
+], dtype=np.float32)
+
+# The 12 triangles of a unit cube (6 faces, 2 triangles each)
+_CUBE_FACES = np.array([
+    [0,3,1], [1,3,2],  # bottom
+    [0,1,5], [0,5,4],  # front
+    [1,2,6], [1,6,5],  # right
+    [2,3,7], [2,7,6],  # back
+    [3,0,4], [3,4,7],  # left
+    [4,5,6], [4,6,7]   # top
+])
+
+# Outward direction of each cube face paired with its two triangles
+_CUBE_FACE_TRIANGLES = [
+    (direction, _CUBE_VERTICES[_CUBE_FACES[2 * i:2 * i + 2]])
+    for i, direction in enumerate([
+        (0, 0, -1),   # bottom
+        (0, -1, 0),   # front
+        (1, 0, 0),    # right
+        (0, 1, 0),    # back
+        (-1, 0, 0),   # left
+        (0, 0, 1)     # top
+    ])
+]
+
+@njit(cache=True, fastmath=True)
+def _axis_separates(ax, ay, az, v0x, v0y, v0z, v1x, v1y, v1z, v2x, v2y, v2z, halfsize):
+    """Check whether an axis separates the triangle from a cube centered at the origin"""
+    p0 = ax * v0x + ay * v0y + az * v0z
+    p1 = ax * v1x + ay * v1y + az * v1z
+    p2 = ax * v2x + ay * v2y + az * v2z
+    r = halfsize * (abs(ax) + abs(ay) + abs(az))
+    return min(p0, p1, p2) > r or max(p0, p1, p2) < -r
+
+@njit(cache=True, fastmath=True)
+def tri_box_overlap(tri_verts, tri_edges, tri_normal, tri_d, box_center, box_halfsize):
+    """Exact triangle/cube overlap using the Akenine-Moller separating axis test"""
+    h = box_halfsize
+    cx, cy, cz = box_center
+    
+    # Triangle normal: the box must straddle the triangle plane
+    nx, ny, nz = tri_normal[0], tri_normal[1], tri_normal[2]
+    if abs(nx * cx + ny * cy + nz * cz + tri_d) > h * (abs(nx) + abs(ny) + abs(nz)):
+        return False
+    
+    # Move the triangle so the box is centered at the origin
+    v0x, v0y, v0z = tri_verts[0, 0] - cx, tri_verts[0, 1] - cy, tri_verts[0, 2] - cz
+    v1x, v1y, v1z = tri_verts[1, 0] - cx, tri_verts[1, 1] - cy, tri_verts[1, 2] - cz
+    v2x, v2y, v2z = tri_verts[2, 0] - cx, tri_verts[2, 1] - cy, tri_verts[2, 2] - cz
+    
+    # Box face normals
+    if min(v0x, v1x, v2x) > h or max(v0x, v1x, v2x) < -h:
+        return False
+    if min(v0y, v1y, v2y) > h or max(v0y, v1y, v2y) < -h:
+        return False
+    if min(v0z, v1z, v2z) > h or max(v0z, v1z, v2z) < -h:
+        return False
+    
+    # Nine cross products of the box axes with the triangle edges
+    zero = np.float32(0.0)
+    for k in range(3):
+        ex, ey, ez = tri_edges[k, 0], tri_edges[k, 1], tri_edges[k, 2]
+        if _axis_separates(zero, -ez, ey, v0x, v0y, v0z, v1x, v1y, v1z, v2x, v2y, v2z, h):
+            return False
+        if _axis_separates(ez, zero, -ex, v0x, v0y, v0z, v1x, v1y, v1z, v2x, v2y, v2z, h):
+            return False
+        if _axis_separates(-ey, ex, zero, v0x, v0y, v0z, v1x, v1y, v1z, v2x, v2y, v2z, h):
+            return False
+    
+    return True
+
+@lru_cache(maxsize=None)
+def _specialized_kernel(resolution):
+    """Compile the rasterization kernel with the grid resolution as a constant
+    
+    Numba freezes closure variables, so the loop bounds, clamps and packed
+    row length below are folded into the machine code for each resolution.
+    Compiled kernels are cached on disk per resolution.
+    """
+    words = (resolution + 63) // 64
+    
+    @njit(cache=True, parallel=True, fastmath=True)
+    def kernel(tri_verts, tri_edges, tri_normals, tri_d, tri_lo, tri_hi, slab_offsets, slab_triangles):
+        bits = np.zeros((resolution, resolution, words), dtype=np.uint64)
+        half = np.float32(0.5)
+        
+        # Each thread owns one x slab, so read-modify-write of the packed words never races
+        for x in prange(resolution):
+            cx = np.float32(x) + half
+            for i in range(slab_offsets[x], slab_offsets[x + 1]):
+                t = slab_triangles[i]
+                verts, edges, normal, d = tri_verts[t], tri_edges[t], tri_normals[t], tri_d[t]
+                
+                for y in range(tri_lo[t, 1], tri_hi[t, 1]):
+                    cy = np.float32(y) + half
+                    for z in range(tri_lo[t, 2], tri_hi[t, 2]):
+                        cz = np.float32(z) + half
+                        if tri_box_overlap(verts, edges, normal, d, (cx, cy, cz), half):
+                            bits[x, y, z >> 6] |= np.uint64(1) << np.uint64(z & 63)
+        
+        return bits
+    
+    return kernel
+
+def voxelize_numba(tri_verts, tri_edges, tri_normals, tri_d, tri_lo, tri_hi, slab_offsets, slab_triangles, resolution):
+    """Mark every voxel that overlaps a triangle given in voxel space
+    
+    tri_lo/tri_hi are the clamped voxel index bounds of each triangle
+    (hi exclusive). Triangles are binned per x slab in CSR form: slab x owns
+    slab_triangles[slab_offsets[x]:slab_offsets[x + 1]]. Returns a
+    bit-packed grid with 64 voxels per uint64 word along z.
+    """
+    kernel = _specialized_kernel(int(resolution))
+    return kernel(tri_verts, tri_edges, tri_normals, tri_d, tri_lo, tri_hi, slab_offsets, slab_triangles)
+
+def unpack_bits(bits, resolution):
+    """Expand a bit-packed grid from voxelize_numba into a dense boolean grid"""
+    packed = np.ascontiguousarray(bits, dtype='<u8').view(np.uint8)
+    return np.unpackbits(packed, axis=2, count=resolution, bitorder='little').view(bool)
+
+# Binary STL triangle record: normal, 3 vertices, attribute byte count
+_STL_RECORD_DTYPE = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('vectors', '<f4', (3, 3)),
+    ('attr', '<u2')
+])
+
+def write_binary_stl(path, triangles, normals=None):
+    """Write an (F, 3, 3) triangle array as a binary STL in a single write"""
+    triangles = np.asarray(triangles, dtype=np.float32)
+    
+    # Unit facet normals, computed from the winding unless the caller knows them
+    if normals is None:
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        np.divide(normals, lengths, out=normals, where=lengths > 0)
+    
+    records = np.zeros(len(triangles), dtype=_STL_RECORD_DTYPE)
+    records['normal'] = normals
+    records['vectors'] = triangles
+    
+    with open(path, 'wb') as f:
+        f.write(bytes(80))  # Empty header
+        f.write(np.array(len(triangles), dtype='<u4').tobytes())
+        f.write(records.tobytes())
 
 class Voxelizer:
     def __init__(self, mesh, resolution):
         self.mesh = mesh
         self.resolution = resolution
         self.voxels = None
+        self.bits = None
+        
+        # Per-triangle geometry in voxel space, stored as struct-of-arrays
+        self.tri_verts = None
+        self.tri_edges = None
+        self.tri_normals = None
+        self.tri_d = None
+        self.tri_lo = None
+        self.tri_hi = None
+        self.slab_offsets = None
+        self.slab_triangles = None
         
     def voxelize(self):
         """Convert mesh to voxels using a surface-based approach"""
-        # Create a 3D grid
-        grid = np.zeros((self.resolution, self.resolution, self.resolution), dtype=bool)
-        
-        # Get all triangles from the mesh
-        triangles = self.mesh.vectors
+        # Get all triangles from the mesh, kept in float32 throughout
+        triangles = np.ascontiguousarray(self.mesh.vectors, dtype=np.float32)
         
         # Get model bounds
         min_coords = triangles.min(axis=(0, 1))
         max_coords = triangles.max(axis=(0, 1))
         
         # Calculate scaling factor with additional padding
-        scale = (self.resolution - 4) / np.max(max_coords - min_coords)  # Increased padding
+        scale = np.float32((self.resolution - 4) / np.max(max_coords - min_coords))  # Increased padding
         
-        # Vectorized triangle processing
-        verts = (triangles - min_coords) * scale
-        verts = np.clip(verts, 0, self.resolution - 4)  # Adjusted clipping
+        # Precompute triangle geometry once in voxel space
+        self._prepare_triangles(triangles, min_coords, scale)
         
-        # Process triangles in smaller batches for better memory management
-        batch_size = 500  # Reduced batch size for higher resolution
-        for i in range(0, len(triangles), batch_size):
-            batch_triangles = triangles[i:i + batch_size]
-            batch_verts = verts[i:i + batch_size]
+        if GPU_AVAILABLE and len(triangles) >= GPU_MIN_TRIANGLES:
+            # Large meshes are rasterized on the GPU when CuPy is installed
+            self.bits = voxelize_gpu(
+                self.tri_verts, self.tri_edges, self.tri_normals, self.tri_d,
+                self.tri_lo, self.tri_hi, self.resolution
+            )
+        else:
+            # Split the triangles into disjoint per-slab work lists
+            self._bin_triangles()
             
-            # Get bounds for all triangles in batch
-            mins = np.floor(np.min(batch_verts, axis=1)).astype(int)
-            maxs = np.ceil(np.max(batch_verts, axis=1)).astype(int)
+            # Rasterize all slabs in parallel into the bit-packed surface grid.
+            # Slabs hold very different triangle counts, so hand them out one at a time.
+            previous_chunksize = set_parallel_chunksize(1)
+            try:
+                self.bits = voxelize_numba(
+                    self.tri_verts, self.tri_edges, self.tri_normals, self.tri_d,
+                    self.tri_lo, self.tri_hi, self.slab_offsets, self.slab_triangles, self.resolution
+                )
+            finally:
+                set_parallel_chunksize(previous_chunksize)
+        
+        filled_grid = np.zeros((self.resolution, self.resolution, self.resolution), dtype=bool)
+        
+        # Post-processing only needs the bounding box of the surface, not the full cube
+        region = self._occupied_region()
+        if region is not None:
+            x_slice, y_slice, z_slice = region
+            surface = unpack_bits(self.bits[x_slice, y_slice], self.resolution)[:, :, z_slice]
             
-            # Process each triangle in batch
-            for triangle, triangle_mins, triangle_maxs in zip(batch_triangles, mins, maxs):
-                x_range = range(max(0, triangle_mins[0]), min(self.resolution - 1, triangle_maxs[0] + 1))
-                y_range = range(max(0, triangle_mins[1]), min(self.resolution - 1, triangle_maxs[1] + 1))
-                z_range = range(max(0, triangle_mins[2]), min(self.resolution - 1, triangle_maxs[2] + 1))
-                
-                if not (x_range and y_range and z_range):
-                    continue
-                
-                # Create mesh grid for points with optimized sampling density
-                x, y, z = np.meshgrid(x_range, y_range, z_range, indexing='ij')
-                points = np.stack([x, y, z], axis=-1).reshape(-1, 3)
-                
-                # Optimized sub-voxel sampling points
-                offsets = np.array([[dx, dy, dz] 
-                                  for dx in [0.25, 0.5, 0.75]  # Simplified sampling points
-                                  for dy in [0.25, 0.5, 0.75]
-                                  for dz in [0.25, 0.5, 0.75]])
-                
-                points = points[:, None] + offsets
-                points = points.reshape(-1, 3)
-                
-                # Convert to original coordinate system
-                points = points / scale + min_coords
-                
-                # Vectorized point-triangle distance check
-                mask = self._points_near_triangle_vectorized(points, triangle, threshold=0.25)  # Adjusted threshold
-                mask = mask.reshape(-1, 27).any(axis=1)  # Adjusted for new sampling count
-                
-                if mask.any():
-                    indices = (points[::27][mask] - min_coords) * scale
-                    indices = np.clip(indices, 0, self.resolution - 1).astype(int)
-                    grid[indices[:, 0], indices[:, 1], indices[:, 2]] = True
+            # The surface shell is closed, so filling it yields the solid volume
+            filled_region = self._fill_interior(surface)
+            
+            # Remove floating voxels
+            self._remove_floating_voxels(filled_region)
+            
+            filled_grid[region] = filled_region
         
-        # Enhanced surface processing and filling
-        struct = np.ones((3, 3, 3))
-        grid = ndimage.binary_dilation(grid, structure=struct, iterations=1)
+        self.voxels = filled_grid
+        return self.voxels
+    
+    def _prepare_triangles(self, triangles, min_coords, scale):
+        """Build contiguous per-triangle vertex, edge, normal and plane offset arrays"""
+        verts = (triangles - min_coords) * scale
+        verts = np.clip(verts, np.float32(0), np.float32(self.resolution - 4))  # Adjusted clipping
+        self.tri_verts = np.ascontiguousarray(verts, dtype=np.float32)
         
-        # Fill internal volumes
-        filled_grid = ndimage.binary_fill_holes(grid)
+        # Edges v0->v1, v1->v2, v2->v0
+        edges = np.roll(self.tri_verts, -1, axis=1) - self.tri_verts
+        self.tri_edges = np.ascontiguousarray(edges, dtype=np.float32)
         
-        # Optimized smoothing passes
-        for _ in range(2):
-            filled_grid = ndimage.binary_closing(filled_grid, structure=struct, iterations=1)
-            filled_grid = ndimage.binary_dilation(filled_grid, structure=struct, iterations=1)
-            filled_grid = ndimage.binary_erosion(filled_grid, structure=struct, iterations=1)
+        # Unnormalized plane normals and offsets (the overlap test is scale invariant)
+        normals = np.cross(self.tri_edges[:, 0], self.tri_edges[:, 1])
+        self.tri_normals = np.ascontiguousarray(normals, dtype=np.float32)
+        self.tri_d = np.ascontiguousarray(-(self.tri_normals * self.tri_verts[:, 0]).sum(axis=1), dtype=np.float32)
         
-        # Remove floating voxels
-        self._remove_floating_voxels(filled_grid)
+        # Clamped voxel index bounds (hi exclusive). Voxel i spans [i, i + 1], so a
+        # triangle reaches voxels ceil(min) - 1 through floor(max) on each axis.
+        lo = np.ceil(self.tri_verts.min(axis=1)).astype(np.int32) - 1
+        hi = np.floor(self.tri_verts.max(axis=1)).astype(np.int32) + 1
+        self.tri_lo = np.clip(lo, 0, self.resolution - 1)
+        self.tri_hi = np.clip(hi, 1, self.resolution)
+    
+    def _bin_triangles(self):
+        """Bin triangle ids by the x slabs their bounds touch (CSR layout)"""
+        first = self.tri_lo[:, 0].astype(np.int64)
+        spans = self.tri_hi[:, 0] - first
         
-        self.voxels = filled_grid
-        return self.voxels
+        # One (slab, triangle) entry per slab touched by each triangle
+        triangle_ids = np.repeat(np.arange(len(spans)), spans)
+        starts = np.cumsum(spans) - spans
+        slabs = np.repeat(first - starts, spans) + np.arange(len(triangle_ids))
+        
+        order = np.argsort(slabs, kind='stable')
+        self.slab_triangles = triangle_ids[order]
+        self.slab_offsets = np.zeros(self.resolution + 1, dtype=np.int64)
+        np.cumsum(np.bincount(slabs, minlength=self.resolution), out=self.slab_offsets[1:])
     
-    def _remove_floating_voxels(self, grid):
-        """Remove voxels that aren't connected to the main structure"""
-        # Label connected components
-        labeled_array, num_features = ndimage.label(grid)
+    def _occupied_region(self):
+        """Get the bounding box of the packed surface grid as slices, or None if empty"""
+        words = self.bits.shape[2]
+        occupied_x = np.flatnonzero(self.bits.any(axis=(1, 2)))
+        if len(occupied_x) == 0:
+            return None
+        occupied_y = np.flatnonzero(self.bits.any(axis=(0, 2)))
         
-        if num_features == 0:
-            return
+        # OR all rows together so z occupancy only needs a single row unpacked
+        z_words = np.bitwise_or.reduce(self.bits.reshape(-1, words), axis=0)
+        occupied_z = np.flatnonzero(unpack_bits(z_words.reshape(1, 1, words), self.resolution))
         
-        # Find the largest component
-        sizes = np.bincount(labeled_array.ravel())
-        sizes[0] = 0  # Ignore background
-        largest_component = sizes.argmax()
+        return (
+            slice(occupied_x[0], occupied_x[-1] + 1),
+            slice(occupied_y[0], occupied_y[-1] + 1),
+            slice(occupied_z[0], occupied_z[-1] + 1)
+        )
+    
+    def _fill_interior(self, surface):
+        """Fill every empty region that can't reach the border of the grid"""
+        # Label empty space once instead of iterating dilations until convergence.
+        # uint16 labels halve memory; heavily fragmented grids fall back to int32.
+        labeled_array = np.empty(surface.shape, dtype=np.uint16)
+        try:
+            num_features = ndimage.label(~surface, output=labeled_array)
+        except RuntimeError:
+            labeled_array, num_features = ndimage.label(~surface)
         
-        # Keep only the largest component
-        grid[:] = (labeled_array == largest_component)
-
-    def _points_near_triangle_vectorized(self, points, triangle, threshold=0.3):
-        """Vectorized version of point-triangle distance check with adjusted threshold"""
-        # Calculate triangle normal
-        v1 = triangle[1] - triangle[0]
-        v2 = triangle[2] - triangle[0]
-        normal = np.cross(v1, v2)
-        normal_length = np.linalg.norm(normal)
-        
-        if normal_length < 1e-10:
-            return np.zeros(len(points), dtype=bool)
-        
-        normal = normal / normal_length
-        
-        # Calculate distances from points to triangle plane
-        v = points - triangle[0]
-        dists = np.abs(np.dot(v, normal))
-        
-        # Early exit for points too far from plane
-        mask = dists <= threshold
-        if not mask.any():
-            return np.zeros(len(points), dtype=bool)
-        
-        # Project points onto triangle plane
-        close_points = points[mask]
-        proj = close_points - dists[mask, None] * normal
-        
-        # Check if projections are inside triangle or near edges
-        edge0 = triangle[1] - triangle[0]
-        edge1 = triangle[2] - triangle[1]
-        edge2 = triangle[0] - triangle[2]
-        
-        C0 = proj - triangle[0]
-        C1 = proj - triangle[1]
-        C2 = proj - triangle[2]
-        
-        # Vectorized inside-triangle test
-        inside = (np.dot(np.cross(edge0, C0), normal) >= -threshold) & \
-                (np.dot(np.cross(edge1, C1), normal) >= -threshold) & \
-                (np.dot(np.cross(edge2, C2), normal) >= -threshold)
-        
-        result = np.zeros(len(points), dtype=bool)
-        result[mask] = inside
-        return result
-    
-    def _create_cube_faces(self, x, y, z):
-        """Create faces for a single voxel cube"""
-        # Define the 8 vertices of a unit cube
-        v = np.array([
-            [x, y, z],         # 0
-            [x+1, y, z],       # 1
-            [x+1, y+1, z],     # 2
-            [x, y+1, z],       # 3
-            [x, y, z+1],       # 4
-            [x+1, y, z+1],     # 5
-            [x+1, y+1, z+1],   # 6
-            [x, y+1, z+1]      # 7
-        ], dtype=float)
-        
-        # Define the 12 triangles (6 faces, 2 triangles each)
-        faces = np.array([
-            [0,3,1], [1,3,2],  # bottom
-            [0,1,5], [0,5,4],  # front
-            [1,2,6], [1,6,5],  # right
-            [2,3,7], [2,7,6],  # back
-            [3,0,4], [3,4,7],  # left
-            [4,5,6], [4,6,7]   # top
-        ])
-        
-        return v, faces
+        # Empty components touching any face of the block are outside the model
+        outside = np.zeros(num_features + 1, dtype=bool)
+        for axis in range(3):
+            outside[labeled_array.take(0, axis=axis)] = True
+            outside[labeled_array.take(-1, axis=axis)] = True
+        outside[0] = False  # Label 0 is the surface itself
+        
+        return ~outside[labeled_array]
     
+    def _remove_floating_voxels(self, grid):
+        """Remove voxels that aren't connected to the main structure"""
+        # Keep only the largest face-connected component
+        grid[:] = cc3d.largest_k(grid, k=1, connectivity=6, binary_image=True) > 0
+
     def save_to_file(self, output_path: str):
         """Save voxels as both NPY and voxelized STL"""
         if self.voxels is None:
@@ -184,39 +320,36 @@ class Voxelizer:
             
         output_path = Path(output_path)
         
-        # Save NPY file
-        np.save(output_path, self.voxels)
-        
-        # Create voxelized STL
-        vertices_list = []
-        faces_list = []
-        vertex_count = 0
-        
-        # Convert each voxel to cube faces
-        for z in range(self.resolution):
-            for y in range(self.resolution):
-                for x in range(self.resolution):
-                    if self.voxels[x, y, z]:
-                        v, f = self._create_cube_faces(x, y, z)
-                        vertices_list.append(v)
-                        faces_list.append(f + vertex_count)
-                        vertex_count += len(v)
-        
-        if vertices_list:  # Only create STL if we have voxels
-            # Combine all vertices and faces
-            vertices = np.vstack(vertices_list)
-            faces = np.vstack(faces_list)
+        # Save NPY file, copying straight into a memory-mapped file instead of buffering the cube
+        npy_path = output_path if output_path.suffix == '.npy' else output_path.with_name(output_path.name + '.npy')
+        npy_file = np.lib.format.open_memmap(str(npy_path), mode='w+', dtype=self.voxels.dtype, shape=self.voxels.shape)
+        npy_file[:] = self.voxels
+        npy_file.flush()
+        del npy_file
+        
+        # Create voxelized STL from the exposed faces only. A face is visible
+        # when the neighboring voxel in its direction is empty.
+        padded = np.pad(self.voxels, 1)
+        res = self.resolution
+        triangles_list = []
+        normals_list = []
+        for direction, face_triangles in _CUBE_FACE_TRIANGLES:
+            dx, dy, dz = direction
+            neighbor = padded[1 + dx:1 + dx + res, 1 + dy:1 + dy + res, 1 + dz:1 + dz + res]
+            exposed = np.argwhere(self.voxels & ~neighbor).astype(np.float32)
+            triangles_list.append(exposed[:, None, None, :] + face_triangles[None])
             
+            # Cube faces are axis aligned, so the outward direction is the facet normal
+            normals_list.append(np.broadcast_to(np.float32(direction), (2 * len(exposed), 3)))
+        
+        triangles = np.concatenate(triangles_list).reshape(-1, 3, 3)
+        normals = np.concatenate(normals_list)
+        
+        if len(triangles):  # Only create STL if we have voxels
             # Scale vertices back to original size
             scale = (self.mesh.vectors.max() - self.mesh.vectors.min()) / self.resolution
-            vertices = vertices * scale + self.mesh.vectors.min()
-            
-            # Create mesh
-            voxel_mesh = mesh.Mesh(np.zeros(len(faces), dtype=mesh.Mesh.dtype))
-            for i, face in enumerate(faces):
-                for j in range(3):
-                    voxel_mesh.vectors[i][j] = vertices[face[j]]
+            triangles = triangles * scale + self.mesh.vectors.min()
             
             # Save voxelized STL
             stl_path = output_path.parent / f"{output_path.stem}_voxelized.stl"
-            voxel_mesh.save(stl_path)
+            write_binary_stl(stl_path, triangles, normals)